@@ -2,24 +2,43 @@
 """
 抓取网页中的 m3u8 链接并输出到 CSV。
 在 Render/Docker 中运行，已加：
-- Chromium 启动参数：--no-sandbox, --disable-dev-shm-usage
+- Chromium 启动参数：--no-sandbox, --disable-dev-shm-usage 等（见 m3u8_common.CHROMIUM_ARGS）
 - 更稳的异常处理与日志输出
 - 轻度滚动与点击播放，触发网络请求
+- async Playwright：单个 browser + 多个 context 并发抓取
 """
 
 import os
+import asyncio
 import re
 import csv
-import json
 from pathlib import Path
-from typing import Set, List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from urllib.parse import urlsplit
 
-from playwright.sync_api import sync_playwright, Page, Frame
+from playwright.async_api import async_playwright, BrowserContext, Page, Frame
+
+from m3u8_common import CHROMIUM_ARGS, canonicalize_m3u8, click_play_in_frames, wait_dom_or_m3u8
 
 # 读取/写入文件名
 INPUT_FILE = "urls.txt"
 OUTPUT_CSV = "m3u8_results.csv"
 
+# 同时打开的页面数量上限（所有站点合计）
+MAX_CONCURRENCY = 8
+
+# 同时打开的站点 context 数量上限；其余站点排队，轮到时才创建 context
+MAX_CONTEXTS = 8
+
+# 导航只等到主文档响应提交（毫秒）；之后交给 response 监听
+GOTO_COMMIT_MS = 15_000
+
+# 需要滚动/点击且尚无 m3u8 时，等 DOM 就绪的上限（秒）
+DOM_WAIT_SEC = 30
+
+# 等待 m3u8 出现的上限（秒）；一旦捕获立即返回
+M3U8_WAIT_SEC = 10
+
 # 点击播放常见选择器
 PLAY_CLICK_SELECTORS = [
     ".vjs-big-play-button",
@@ -30,6 +49,37 @@ PLAY_CLICK_SELECTORS = [
     "div[class*=play]",
 ]
 
+# JSON/文本中内嵌的 m3u8 链接（模块级预编译，避免每个响应都查 re 缓存）
+M3U8_RE = re.compile(r"https?://[^\"'\s]+?\.m3u8[^\"'\s]*")
+
+# 抓 m3u8 用不到的静态资源/广告统计，通过 CDP 直接屏蔽
+# 取舍：context.route 能按资源类型拦截，但启用路由会让 Chromium 关闭 HTTP 缓存；
+# 这里同站点页面共享 context 的缓存，所以只用 URL 模式屏蔽；grab_m3u8.py 选了 route，换来按类型拦截
+BLOCKED_URL_PATTERNS = [
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.webp",
+    "*.svg",
+    "*.ico",
+    "*.woff*",
+    "*.ttf",
+    "*.css",
+    # 广告/统计按主机名写成 *://*.域名/* 的形式，参数里只是提到这些名字的请求不会被误拦
+    "*://*.googletagmanager.com/*",
+    "*://*.google-analytics.com/*",
+    "*://*.doubleclick.net/*",
+]
+
+# 一次取回标题与媒体元素地址
+PAGE_INFO_JS = """() => ({
+    title: document.title,
+    sources: Array.from(document.querySelectorAll("video,source,iframe"))
+        .map((e) => e.currentSrc || e.src)
+        .filter(Boolean),
+})"""
+
 # 统一 UA（与你的后端保持一致）
 UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
@@ -45,23 +95,29 @@ def load_urls(path: str) -> List[str]:
     file = Path(path)
     if not file.exists():
         raise FileNotFoundError(f"找不到 {path}")
-    urls: List[str] = []
+    urls: Dict[str, None] = {}
     for line in file.read_text(encoding="utf-8").splitlines():
         s = line.strip()
         if s and not s.startswith("#"):
-            urls.append(s)
-    return urls
+            urls[s] = None  # 去重并保持顺序
+    return list(urls)
 
 
-def looks_like_m3u8(url: str, ct: Optional[str]) -> bool:
-    u = (url or "").lower()
-    if ".m3u8" in u:
+def looks_like_m3u8(url_l: str, ct_l: Optional[str]) -> bool:
+    """
+    参数为调用方已转小写的 URL 与 content-type，避免每次检查都复制一遍字符串。
+    """
+    if ".m3u8" in url_l:
         return True
-    if ct:
-        ct = ct.lower()
-        if "application/vnd.apple.mpegurl" in ct or "application/x-mpegurl" in ct:
-            return True
-    return False
+    # application/vnd.apple.mpegurl 与 application/x-mpegurl 共有 "mpegurl"，一次子串扫描即可
+    return bool(ct_l) and "mpegurl" in ct_l
+
+
+def is_m3u8_path(url: str) -> bool:
+    """
+    路径（不含 query）以 .m3u8 结尾。
+    """
+    return urlsplit(url).path.lower().endswith(".m3u8")
 
 
 def infer_m3u8_from_ts(ts_url: str) -> List[str]:
@@ -77,70 +133,111 @@ def infer_m3u8_from_ts(ts_url: str) -> List[str]:
     ]
 
 
-def try_click_play(frame_like) -> bool:
+async def try_click_play(frame_like) -> bool:
     """
     在主页面或子 frame 上尝试点击播放按钮。
     """
     for sel in PLAY_CLICK_SELECTORS:
         try:
             el = frame_like.locator(sel).first
-            if el.count() > 0:
-                el.click(timeout=1500)
+            if await el.count() > 0:
+                await el.click(timeout=1500)
                 return True
         except Exception:
             continue
     return False
 
 
-def human_title(page: Page) -> str:
+async def block_heavy_resources(context: BrowserContext, page: Page) -> None:
+    """
+    用 Network.setBlockedURLs 屏蔽图片/字体/样式/广告请求，减少页面加载流量。
+    """
     try:
-        t = (page.title() or "").strip()
-        return t if t else "unknown"
+        client = await context.new_cdp_session(page)
+        await client.send("Network.enable")
+        await client.send("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
     except Exception:
-        return "unknown"
+        # 屏蔽失败只影响速度，不影响抓取
+        pass
 
 
-def crawl_one(page: Page, page_url: str) -> List[Dict[str, str]]:
+async def wait_for_m3u8(hit: asyncio.Event, timeout: float) -> bool:
+    """
+    等到 on_response 捕获 m3u8 或超时，返回是否命中。
+    """
+    try:
+        await asyncio.wait_for(hit.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+async def page_info(page: Page) -> Tuple[str, List[str]]:
+    """
+    一次 evaluate 同时取回页面标题和 <video>/<source>/<iframe> 的 src，
+    省掉单独的 title() 往返；返回 (标题, src 列表)。
+    """
+    try:
+        info = await page.evaluate(PAGE_INFO_JS)
+    except Exception:
+        return "unknown", []
+    t = (info.get("title") or "").strip()
+    return (t if t else "unknown"), info.get("sources") or []
+
+
+async def crawl_one(page: Page, page_url: str) -> List[Dict[str, str]]:
     """
     打开单个页面，监听所有响应，提取 m3u8。
     返回该页面的结果字典列表。
     """
-    found_m3u8: Set[str] = set()
-    hinted_m3u8: Set[str] = set()
+    # 键为规范化地址；dict 保持插入顺序，插入即去重，输出时无需排序
+    found_m3u8: Dict[str, None] = {}
+    hinted_m3u8: Dict[str, None] = {}
+    seen_ts_dirs: set = set()
+    m3u8_hit = asyncio.Event()
 
-    def on_response(resp):
+    async def on_response(resp):
         try:
             url = resp.url or ""
             headers = resp.headers or {}
-            ct = headers.get("content-type", "")
-            # 1) 直接命中 m3u8
-            if looks_like_m3u8(url, ct):
-                found_m3u8.add(url)
-                return
+            # 每个响应只转一次小写，后面的判断都复用
+            url_l = url.lower()
+            ct_l = headers.get("content-type", "").lower()
+            # 1) 直接命中 m3u8：content-type 是播放列表，或规范化后是 .m3u8 路径
+            #    （地址里只是提到 .m3u8 的解析页等不算，继续走后面的检查）
+            if looks_like_m3u8(url_l, ct_l):
+                key = canonicalize_m3u8(url)
+                if "mpegurl" in ct_l or is_m3u8_path(key):
+                    found_m3u8[key] = None
+                    m3u8_hit.set()
+                    return
 
             # 2) JSON 里嵌有 m3u8
-            if "application/json" in ct.lower() or url.lower().endswith(".json"):
+            if "application/json" in ct_l or url_l.endswith(".json"):
                 try:
                     # 读取文本（大文件/流式也基本可行）
-                    txt = resp.text()
-                    blob = txt
-                    # 尝试美化 JSON 再正则，容错
-                    s = txt.strip()
-                    if s.startswith("{") or s.startswith("["):
-                        try:
-                            d = json.loads(txt)
-                            blob = json.dumps(d, ensure_ascii=False)
-                        except Exception:
-                            pass
-                    for m in re.findall(r"https?://[^\"'\\s]+?\.m3u8[^\"'\\s]*", blob):
-                        found_m3u8.add(m)
+                    txt = await resp.text()
+                    # 先做一次线性子串扫描，绝大多数不含 m3u8 的 JSON 不必进正则
+                    if ".m3u8" in txt:
+                        # 正则直接跑原文即可；只需还原 JSON 里转义的 "\/"
+                        if "\\/" in txt:
+                            txt = txt.replace("\\/", "/")
+                        for m in M3U8_RE.findall(txt):
+                            key = canonicalize_m3u8(m)
+                            if is_m3u8_path(key):
+                                found_m3u8[key] = None
+                                m3u8_hit.set()
                 except Exception:
                     pass
 
             # 3) 看到 ts 则猜测目录下的 m3u8 常名
-            if ".ts" in url.lower():
-                for cand in infer_m3u8_from_ts(url):
-                    hinted_m3u8.add(cand)
+            #    同一目录的分片推断结果相同，每个目录只推断一次
+            if ".ts" in url_l:
+                ts_dir = url.rsplit("/", 1)[0]
+                if ts_dir not in seen_ts_dirs:
+                    seen_ts_dirs.add(ts_dir)
+                    for cand in infer_m3u8_from_ts(url):
+                        hinted_m3u8[canonicalize_m3u8(cand)] = None
         except Exception:
             # 不让监听崩
             pass
@@ -149,40 +246,49 @@ def crawl_one(page: Page, page_url: str) -> List[Dict[str, str]]:
 
     log(f"[OPEN] {page_url}")
     try:
-        page.goto(page_url, wait_until="domcontentloaded", timeout=45_000)
+        # 只等主文档响应提交，m3u8 由 on_response 在后台收集
+        await page.goto(page_url, wait_until="commit", timeout=GOTO_COMMIT_MS)
     except Exception:
-        # 有些站点会劫持/跳转，尽量不因 goto 失败直接返回
+        # 超时或被劫持/跳转都继续：浏览器之后发出的 m3u8 照样会被监听到
         pass
 
-    # 轻微滚动/等待加载，触发更多请求
-    try:
-        page.wait_for_timeout(1500)
-        page.evaluate("window.scrollTo(0, document.body.scrollHeight/2);")
-        page.wait_for_timeout(1200)
-        page.evaluate("window.scrollTo(0, document.body.scrollHeight);")
-        page.wait_for_timeout(1200)
-    except Exception:
-        pass
+    if not m3u8_hit.is_set():
+        # 滚动/点击需要 DOM；等待期间若已抓到 m3u8 就不再交互
+        await wait_dom_or_m3u8(page, m3u8_hit, DOM_WAIT_SEC)
 
-    # 尝试点击播放
-    try_click_play(page)
-    try:
-        for fr in page.frames:
-            try_click_play(fr)
-    except Exception:
-        pass
+    if not m3u8_hit.is_set():
+        # 轻微滚动，触发懒加载请求
+        try:
+            await page.evaluate("window.scrollTo(0, document.body.scrollHeight/2);")
+            await page.evaluate("window.scrollTo(0, document.body.scrollHeight);")
+        except Exception:
+            pass
+
+        # 尝试点击播放：主页面，再并发尝试各子 frame
+        await try_click_play(page)
+        await click_play_in_frames(page, try_click_play)
 
-    # 再等网络请求
-    page.wait_for_timeout(5_000)
-    page.wait_for_timeout(3_000)
+    # 等网络请求：捕获到 m3u8 即返回，否则最多再等到 networkidle
+    if not await wait_for_m3u8(m3u8_hit, M3U8_WAIT_SEC):
+        try:
+            await page.wait_for_load_state("networkidle", timeout=3_000)
+        except Exception:
+            pass
 
-    # 页面标题（用于标注）
-    title = human_title(page)
+    # 结果已定，先摘掉监听，之后到达的响应不再改动集合
+    page.remove_listener("response", on_response)
+
+    # 页面标题（用于标注）+ DOM 里直接写明的 m3u8（<video src=...m3u8> 等）
+    title, sources = await page_info(page)
+    for src in sources:
+        key = canonicalize_m3u8(src)
+        if is_m3u8_path(key):
+            found_m3u8[key] = None
 
     results: List[Dict[str, str]] = []
     if not found_m3u8 and hinted_m3u8:
         # 仅推断，需二次验证
-        for u in sorted(hinted_m3u8):
+        for u in hinted_m3u8:
             results.append(
                 {
                     "title": title,
@@ -195,7 +301,7 @@ def crawl_one(page: Page, page_url: str) -> List[Dict[str, str]]:
             )
         log(f"[HINT] 仅推断到候选 m3u8：{len(hinted_m3u8)} | 标题: {title}")
     elif found_m3u8:
-        for u in sorted(found_m3u8):
+        for u in found_m3u8:
             results.append(
                 {
                     "title": title,
@@ -213,45 +319,82 @@ def crawl_one(page: Page, page_url: str) -> List[Dict[str, str]]:
     return results
 
 
-def main():
-    urls = load_urls(INPUT_FILE)
-    all_rows: List[Dict[str, str]] = []
-
-    with sync_playwright() as p:
-        # 关键：容器内必须关闭沙箱并使用 shm 降低内存占用
-        browser = p.chromium.launch(
-            headless=True,
-            args=["--no-sandbox", "--disable-dev-shm-usage"],
-        )
-        context = browser.new_context(
-            user_agent=UA,
-            locale="zh-CN",
-            ignore_https_errors=True,  # 某些站点证书不规范
-        )
+def group_by_netloc(urls: List[str]) -> List[List[str]]:
+    """
+    按域名分组（保持输入顺序），同站点 URL 共用一个 context 以共享 HTTP 缓存。
+    """
+    groups: Dict[str, List[str]] = {}
+    for u in urls:
+        groups.setdefault(urlsplit(u).netloc.lower(), []).append(u)
+    return list(groups.values())
 
-        try:
-            for page_url in urls:
-                page = context.new_page()
-                rows = crawl_one(page, page_url)
-                all_rows.extend(rows)
+
+async def crawl_all(urls: List[str]) -> List[Dict[str, str]]:
+    """
+    单个 browser，每个站点一个 context：HTTP 缓存属于 context，同站点页面共享播放器脚本等缓存。
+    两个信号量分别限制同时打开的 context 数与所有站点合计的页面数，同站点的 URL 也并发抓取。
+    """
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+        sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        ctx_sem = asyncio.Semaphore(MAX_CONTEXTS)
+
+        async def crawl_url(context: BrowserContext, page_url: str) -> List[Dict[str, str]]:
+            async with sem:
+                page = None
                 try:
-                    page.close()
-                except Exception:
-                    pass
+                    page = await context.new_page()
+                    await block_heavy_resources(context, page)
+                    return await crawl_one(page, page_url)
+                except Exception as e:
+                    log(f"[ERR] {page_url}: {e}")
+                    return []
+                finally:
+                    if page is not None:
+                        try:
+                            await page.close()
+                        except Exception:
+                            pass
+
+        async def crawl_site(group: List[str]) -> List[Dict[str, str]]:
+            async with ctx_sem:
+                try:
+                    context = await browser.new_context(
+                        user_agent=UA,
+                        locale="zh-CN",
+                        ignore_https_errors=True,  # 某些站点证书不规范
+                    )
+                except Exception as e:
+                    log(f"[ERR] {group[0]}: {e}")
+                    return []
+                try:
+                    per_page = await asyncio.gather(*(crawl_url(context, u) for u in group))
+                finally:
+                    try:
+                        await context.close()
+                    except Exception:
+                        pass
+            return [row for rows in per_page for row in rows]
+
+        try:
+            per_site = await asyncio.gather(*(crawl_site(g) for g in group_by_netloc(urls)))
         finally:
             try:
-                context.close()
-            except Exception:
-                pass
-            try:
-                browser.close()
+                await browser.close()
             except Exception:
                 pass
 
-    # 去重：按 (m3u8_url, title)
-    uniq: Dict[tuple, Dict[str, str]] = {}
-    for r in all_rows:
-        uniq[(r["m3u8_url"], r["title"])] = r
+    return [row for rows in per_site for row in rows]
+
+
+def main():
+    urls = load_urls(INPUT_FILE)
+    rows = asyncio.run(crawl_all(urls))
+
+    # 不同页面可能给出同一条流（带参数的页面变体、TS 推断等），跨页按规范化地址去重，保留第一条
+    uniq: Dict[str, Dict[str, str]] = {}
+    for r in rows:
+        uniq.setdefault(r["m3u8_url"], r)
     all_rows = list(uniq.values())
 
     # 写 CSV
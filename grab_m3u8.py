@@ -1,9 +1,47 @@
-import csv, re, json, os, urllib.parse
-from playwright.sync_api import sync_playwright
+import argparse, asyncio, csv, re, os, urllib.parse, multiprocessing, queue, hashlib, json, operator, sqlite3, time
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from playwright.async_api import async_playwright, Browser, Page
+from m3u8_common import CHROMIUM_ARGS, canonicalize_m3u8, click_play_in_frames, wait_dom_or_m3u8
 
 INPUT_FILE = "urls.txt"
 OUTPUT_CSV = "m3u8_results.csv"
 
+# 同一 context 内同时打开的页面数
+MAX_PARALLEL_PAGES = 6
+
+# 导航只等到主文档响应提交（毫秒），需要点播放时等 DOM 就绪的上限（秒）
+GOTO_COMMIT_MS = 15000
+DOM_WAIT_SEC = 30.0
+
+# 等待首个 m3u8 的上限（秒）与命中后的补充等待（毫秒）
+M3U8_WAIT_SEC = 6.0
+M3U8_GRACE_MS = 500
+
+# 页面结果缓存：抓到 m3u8 的保留一天，没抓到的一小时后重试
+CACHE_FILE = ".m3u8_cache.sqlite"
+CACHE_TTL_SEC = 24 * 3600
+CACHE_MISS_TTL_SEC = 3600
+
+# URL 数超过该值时按进程分片，每个进程各跑一个 Chromium（单个 Chromium 并发页面有限）
+SHARD_THRESHOLD = 50
+# 分片进程数上限（每个进程一个 Chromium + MAX_PARALLEL_PAGES 个页面），可用 --procs 覆盖
+MAX_SHARD_PROCS = 4
+
+# 超过此大小的 JSON 响应不做 m3u8 扫描（也不从浏览器拉取响应体）
+MAX_JSON_BYTES = 2 * 1024 * 1024
+
+# 这些类型的响应不参与检测；media 保留：<video> 直接加载的 m3u8 与 ts 分片属于 media
+SKIP_RESOURCE_TYPES = {"image", "font", "stylesheet", "websocket"}
+
+# 直接在网络层中止的请求：与 m3u8 无关的静态资源与广告/统计（只比对主机名，不看 query）
+# 用 context.route 是为了按 resource_type 拦截，代价是 Chromium 会关闭 HTTP 缓存，
+# 取舍见 app.py 的 BLOCKED_URL_PATTERNS
+# （不拦 media：被中止的请求不会产生 response 事件，ts/m3u8 就看不到了）
+BLOCKED_RESOURCE_TYPES = {"image", "font", "stylesheet"}
+BLOCKED_HOSTS = ("googletagmanager", "doubleclick", "google-analytics")
+
 PLAY_CLICK_SELECTORS = [
     ".vjs-big-play-button",
     ".plyr__control--overlaid",
@@ -12,30 +50,61 @@ PLAY_CLICK_SELECTORS = [
     ".btn-play,.start,.play"
 ]
 
+CSV_FIELDS = ("title", "page_url", "m3u8_url", "referer", "user_agent", "note")
+row_values = operator.itemgetter(*CSV_FIELDS)
+
+UA = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+      "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+
+# 直接在响应原始字节上匹配，只对命中的片段做 UTF-8 解码
+M3U8_RE = re.compile(rb"https?://[^\"'\s]+?\.m3u8[^\"'\s]*")
+
 def load_urls(path):
     if not os.path.exists(path):
         raise FileNotFoundError(f"找不到 {path}")
     with open(path, "r", encoding="utf-8") as f:
         return [l.strip() for l in f if l.strip() and not l.strip().startswith("#")]
 
-def looks_like_m3u8(url:str, ct:str|None):
-    u = url.lower()
-    if ".m3u8" in u: return True
-    if ct:
-        ct = ct.lower()
-        if "application/vnd.apple.mpegurl" in ct or "application/x-mpegurl" in ct:
-            return True
-    return False
+def looks_like_m3u8(url_l:str, ct_l:str):
+    """参数为调用方已转小写的 URL 与 content-type，避免每次检查都复制一遍字符串。"""
+    if ".m3u8" in url_l: return True
+    return "application/vnd.apple.mpegurl" in ct_l or "application/x-mpegurl" in ct_l
+
+def iter_json_strings(node):
+    """递归产出解析后 JSON 里的所有字符串（键和值）。"""
+    if isinstance(node, str):
+        yield node
+    elif isinstance(node, dict):
+        for k, v in node.items():
+            yield k
+            yield from iter_json_strings(v)
+    elif isinstance(node, list):
+        for v in node:
+            yield from iter_json_strings(v)
+
+def find_m3u8_in_json(raw: bytes, deep: bool = False) -> list[str]:
+    """从 JSON 响应体里找出 m3u8 链接。
+    默认直接在原始字节上跑正则，只还原 JSON 里转义的 "\\/"，不做任何解析；
+    deep 时用 orjson 解析一次，逐个检查字符串值（能处理 \\u002F 等其它转义），不再重新序列化。"""
+    blobs = None
+    if deep:
+        try:
+            blobs = [s.encode("utf-8") for s in iter_json_strings(orjson.loads(raw)) if ".m3u8" in s]
+        except orjson.JSONDecodeError:
+            pass   # 不是合法 JSON，退回原文扫描
+    if blobs is None:
+        blobs = [raw.replace(b"\\/", b"/") if b"\\/" in raw else raw]
+    return [m.decode("utf-8", "ignore") for b in blobs for m in M3U8_RE.findall(b)]
 
 def infer_m3u8_from_ts(url:str):
     base = url.rsplit("/", 1)[0]
     cands = [f"{base}/index.m3u8", f"{base}/playlist.m3u8", f"{base}/master.m3u8", f"{base}/video.m3u8"]
     return cands
 
-def try_click_play(frame_like):
+async def try_click_play(frame_like):
     for sel in PLAY_CLICK_SELECTORS:
         try:
-            frame_like.locator(sel).first.click(timeout=1500)
+            await frame_like.locator(sel).first.click(timeout=1500)
             return True
         except Exception:
             continue
@@ -43,163 +112,398 @@ def try_click_play(frame_like):
 
 # ============ 规范化与强去重 ============
 
-def normalize_m3u8(url: str) -> str:
-    """将 m3u8 地址规范化：仅保留到第一个 .m3u8 为止，去掉 query/fragment，host 小写。"""
-    if not url:
-        return url
-    m = re.search(r'https?://[^"\']+?\.m3u8', url, re.I)
-    core = m.group(0) if m else url
-    parts = urllib.parse.urlsplit(core)
-    core2 = urllib.parse.urlunsplit((
-        parts.scheme.lower(),
-        parts.netloc.lower(),
-        parts.path,
-        "", ""   # 去掉 query / fragment
-    ))
-    return core2
-
-def prefer_master_then_unique(urls: list[str]) -> list[str]:
-    """如同目录下既有 master.m3u8 又有 index/playlist 等，优先仅保留 master。"""
-    seen, ordered = set(), []
-    for u in urls:
-        k = normalize_m3u8(u)
-        if k not in seen:
-            seen.add(k)
-            ordered.append(k)
-
-    masters = [u for u in ordered if u.endswith("master.m3u8")]
-    if not masters:
-        return ordered
-
-    keep_dirs = {u.rsplit("/", 1)[0] for u in masters}
-    result, kept_dir = [], set()
-    for u in ordered:
-        d = u.rsplit("/", 1)[0]
-        if d in keep_dirs and u.endswith("master.m3u8"):
-            if d not in kept_dir:
-                kept_dir.add(d)
-                result.append(u)
-    return result or ordered
+class PreferredM3u8:
+    """边收集边规范化去重：出现过 master.m3u8 时只保留 master（每目录一个），
+    否则保留全部。每个 URL 插入 O(1)，取结果时无需排序或再过一遍。"""
+
+    def __init__(self):
+        self.best_by_dir: dict[str, str] = {}   # 目录 -> master.m3u8
+        self.others: dict[str, None] = {}       # 非 master，按插入顺序去重
+
+    def add(self, url: str) -> None:
+        k = canonicalize_m3u8(url)
+        if k.endswith("master.m3u8"):
+            self.best_by_dir.setdefault(k.rsplit("/", 1)[0], k)
+        else:
+            self.others[k] = None
+
+    def __bool__(self) -> bool:
+        return bool(self.best_by_dir or self.others)
+
+    def urls(self) -> list[str]:
+        return list(self.best_by_dir.values()) or list(self.others)
 
 # =======================================
 
-def main():
-    urls = load_urls(INPUT_FILE)
+async def block_heavy(route):
+    req = route.request
+    host = urllib.parse.urlsplit(req.url).hostname or ""
+    if req.resource_type in BLOCKED_RESOURCE_TYPES or any(h in host for h in BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def crawl(browser: Browser, urls: list[str], log: Callable[[str], None],
+                emit: Callable[[str, list[dict]], None], deep_json: bool = False) -> None:
+    """在给定 browser 上新建一个独立 context 并发抓取 urls，结束后只关闭 context。
+    页面预先建好放进池子（池大小即并发数，最多 MAX_PARALLEL_PAGES），各 URL 轮流复用；
+    每个 URL 完成后立即以 emit(page_url, rows) 交出结果（出错的 URL 不交出）。"""
+    context = await browser.new_context(user_agent=UA, locale="zh-CN")
+    await context.route("**/*", block_heavy)
+    # 池里的 None 表示空槽位：上一个页面出错被关掉，下一个拿到它的 URL 再新建
+    pool: asyncio.Queue[Page | None] = asyncio.Queue()
+
+    async def process_url(page_url: str) -> None:
+        page = await pool.get()
+        try:
+            if page is None:
+                page = await context.new_page()
+            emit(page_url, await crawl_page(page, page_url, log, deep_json))
+        except Exception as e:
+            # 单个页面出错（包括新建页面失败）不影响其它并发任务；出错页面状态不可信，关掉
+            log(f"[ERR] {page_url}: {e}")
+            if page is not None:
+                try:
+                    await page.close()
+                except Exception:
+                    pass
+            page = None
+        finally:
+            if page is not None:
+                try:
+                    await page.goto("about:blank")
+                except Exception:
+                    pass
+            # 槽位总要放回去，否则排队的 URL 会一直等下去
+            pool.put_nowait(page)
+
+    try:
+        for _ in range(min(MAX_PARALLEL_PAGES, len(urls))):
+            pool.put_nowait(await context.new_page())
+        await asyncio.gather(*(process_url(u) for u in urls))
+    finally:
+        await context.close()
+
+async def crawl_page(page: Page, page_url: str, log: Callable[[str], None],
+                     deep_json: bool = False) -> list[dict]:
     results = []
+    found_m3u8 = PreferredM3u8()
+    hinted_m3u8 = PreferredM3u8()
+    seen_ts_dirs = set()
+    m3u8_event = asyncio.Event()
 
-    UA = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-          "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(user_agent=UA, locale="zh-CN")
-
-        for page_url in urls:
-            page = context.new_page()
-            found_m3u8 = set()
-            hinted_m3u8 = set()
-
-            def on_response(resp):
-                url = resp.url
-                ct = resp.headers.get("content-type","")
-                if looks_like_m3u8(url, ct):
-                    found_m3u8.add(url)
-                    return
-                if "application/json" in ct.lower() or url.lower().endswith(".json"):
-                    try:
-                        txt = resp.text()
-                        blob = txt
-                        if txt.strip().startswith("{") or txt.strip().startswith("["):
-                            try:
-                                data = json.loads(txt)
-                                blob = json.dumps(data, ensure_ascii=False)
-                            except:
-                                pass
-                        for m in re.findall(r"https?://[^\"'\\s]+?\.m3u8[^\"'\\s]*", blob):
+    async def on_response(resp):
+        # 图片/字体/样式等不可能带 m3u8，进任何字符串处理前先丢掉
+        if resp.request.resource_type in SKIP_RESOURCE_TYPES:
+            return
+        url = resp.url
+        # 每个响应只转一次小写，后面的判断都复用
+        url_l = url.lower()
+        ct_l = resp.headers.get("content-type", "").lower()
+        if looks_like_m3u8(url_l, ct_l):
+            found_m3u8.add(url)
+            m3u8_event.set()
+            return
+        if "application/json" in ct_l or url_l.endswith(".json"):
+            # 先看 Content-Length：过大的响应体根本不经 IPC 管道传到 Python
+            cl = resp.headers.get("content-length", "")
+            if not (cl.isdigit() and int(cl) > MAX_JSON_BYTES):
+                try:
+                    raw = await resp.body()
+                    # 无 Content-Length（chunked）时读完再按实际大小过滤；
+                    # 不含 .m3u8 的 JSON（统计、配置等）直接跳过，省掉正则
+                    if len(raw) <= MAX_JSON_BYTES and b".m3u8" in raw:
+                        for m in find_m3u8_in_json(raw, deep_json):
                             found_m3u8.add(m)
-                    except Exception:
-                        pass
-                if ".ts" in url.lower():
-                    for cand in infer_m3u8_from_ts(url):
-                        hinted_m3u8.add(cand)
+                            m3u8_event.set()
+                except Exception:
+                    pass
+        if ".ts" in url_l:
+            # 同一目录的分片推断结果相同，每个目录只推断一次
+            ts_dir = url.rsplit("/", 1)[0]
+            if ts_dir not in seen_ts_dirs:
+                seen_ts_dirs.add(ts_dir)
+                for cand in infer_m3u8_from_ts(url):
+                    hinted_m3u8.add(cand)
 
-            page.on("response", on_response)
+    page.on("response", on_response)
 
-            print(f"[OPEN] {page_url}")
-            try:
-                page.goto(page_url, wait_until="domcontentloaded", timeout=45000)
-            except Exception:
-                pass
+    log(f"[OPEN] {page_url}")
+    try:
+        # 只等主文档响应提交，其余交给 on_response 和后面的事件等待
+        await page.goto(page_url, wait_until="commit", timeout=GOTO_COMMIT_MS)
+    except Exception:
+        pass  # 超时等也继续，监听器仍会收集之后发出的 m3u8
 
-            try_click_play(page)
-            try:
-                for fr in page.frames:
-                    try_click_play(fr)
-            except Exception:
-                pass
+    # commit 时 DOM 还没就绪；点击前等 DOM，期间捕获到 m3u8 就提前结束
+    if not m3u8_event.is_set():
+        await wait_dom_or_m3u8(page, m3u8_event, DOM_WAIT_SEC)
+
+    # 导航期间已经捕获到 m3u8 就不必再点播放（逐个选择器点击失败也要耗时）
+    if not m3u8_event.is_set():
+        await try_click_play(page)
+        # 各子 frame 的点击互不依赖，并发尝试
+        await click_play_in_frames(page, try_click_play)
 
-            page.wait_for_timeout(7000)
-            page.wait_for_timeout(5000)
+    # 首个 m3u8 出现即停止等待，M3U8_WAIT_SEC 只是兜底上限
+    try:
+        await asyncio.wait_for(m3u8_event.wait(), timeout=M3U8_WAIT_SEC)
+    except asyncio.TimeoutError:
+        pass
+    else:
+        # 稍等片刻，收齐同时发出的 master / 子码率；
+        # 用 asyncio.sleep 而非 page.wait_for_timeout：这期间页面关闭/崩溃也不丢已捕获的结果
+        await asyncio.sleep(M3U8_GRACE_MS / 1000)
 
+    # 页面会回到池子给下一个 URL 用，先摘掉本次的监听
+    page.remove_listener("response", on_response)
+
+    try:
+        title = (await page.title()).strip()
+    except Exception:
+        title = "unknown"
+
+    if not found_m3u8 and hinted_m3u8:
+        final = hinted_m3u8.urls()
+        for u in final:
+            results.append({
+                "title": title,
+                "page_url": page_url,
+                "m3u8_url": u,
+                "referer": page_url,
+                "user_agent": UA,
+                "note": "推断自TS（需验证）"
+            })
+        log(f"[HINT] 仅推断到候选 m3u8：{len(final)} | 标题: {title}")
+    elif found_m3u8:
+        final = found_m3u8.urls()
+        for u in final:
+            results.append({
+                "title": title,
+                "page_url": page_url,
+                "m3u8_url": u,
+                "referer": page_url,
+                "user_agent": UA,
+                "note": "捕获"
+            })
+        log(f"[OK] 捕获 m3u8：{len(final)} | 标题: {title}")
+    else:
+        log(f"[WARN] 未抓到 m3u8：{page_url}")
+
+    return results
+
+def available_cpus() -> int:
+    """本进程实际能用的 CPU 数：容器里 os.cpu_count() 报的是宿主机核数，
+    这里取 CPU 亲和性，再按 cgroup v2 的 cpu.max 配额收紧。"""
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:   # 非 Linux 没有亲和性接口
+        n = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            n = min(n, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return n
+
+def shard_count(n_urls: int, procs: int | None = None) -> int:
+    """分片进程数；返回 1 表示不分片、在本进程内抓取。
+    URL 不超过 SHARD_THRESHOLD 时不分片；procs 未指定时取可用 CPU 的一半，最多 MAX_SHARD_PROCS。"""
+    if n_urls <= SHARD_THRESHOLD:
+        return 1
+    if procs is None:
+        procs = min(available_cpus() // 2, MAX_SHARD_PROCS)
+    return max(1, min(procs, n_urls))
+
+def crawl_shard(urls: list[str], deep_json: bool, q) -> None:
+    """子进程入口：独立启动 Playwright + Chromium 抓取一片 URL。
+    日志与每个 URL 的结果随时经 q 发回主进程：("log", msg) / ("rows", page_url, rows)；
+    结束时（包括出错）发 ("done",)。"""
+    log = lambda msg: q.put(("log", msg))
+
+    async def go():
+        async with async_playwright() as p:
+            b = await p.chromium.launch(headless=True, args=CHROMIUM_ARGS)
             try:
-                title = page.title().strip()
-            except Exception:
-                title = "unknown"
-
-            if not found_m3u8 and hinted_m3u8:
-                final = prefer_master_then_unique(sorted(hinted_m3u8))
-                for u in final:
-                    results.append({
-                        "title": title,
-                        "page_url": page_url,
-                        "m3u8_url": u,
-                        "referer": page_url,
-                        "user_agent": UA,
-                        "note": "推断自TS（需验证）"
-                    })
-                print(f"[HINT] 仅推断到候选 m3u8：{len(final)} | 标题: {title}")
-            elif found_m3u8:
-                final = prefer_master_then_unique(sorted(found_m3u8))
-                for u in final:
-                    results.append({
-                        "title": title,
-                        "page_url": page_url,
-                        "m3u8_url": u,
-                        "referer": page_url,
-                        "user_agent": UA,
-                        "note": "捕获"
-                    })
-                print(f"[OK] 捕获 m3u8：{len(final)} | 标题: {title}")
+                await crawl(b, urls, log, lambda u, rows: q.put(("rows", u, rows)), deep_json)
+            finally:
+                await b.close()
+
+    try:
+        asyncio.run(go())
+    except Exception as e:
+        log(f"[ERR] 分片进程出错：{e}")
+    finally:
+        q.put(("done",))
+
+async def crawl_sharded(urls: list[str], log: Callable[[str], None],
+                        emit: Callable[[str, list[dict]], None], deep_json: bool = False,
+                        n: int = 2) -> None:
+    """把 urls 轮流分给 n 个子进程。子进程每抓完一个 URL 就经队列发回，主进程随即 emit
+    （照常逐个落盘、写缓存），日志也转交给 log；某个分片出错不影响其它分片。"""
+    shards = [urls[i::n] for i in range(n)]
+    log(f"[SHARD] {len(urls)} 个 URL 分到 {n} 个进程")
+    # spawn：Playwright 内部有线程与事件循环，fork 出来的子进程不安全
+    ctx = multiprocessing.get_context("spawn")
+    q = ctx.Queue()
+    procs = [ctx.Process(target=crawl_shard, args=(s, deep_json, q)) for s in shards]
+    for pr in procs:
+        pr.start()
+    loop = asyncio.get_running_loop()
+
+    def next_msg():
+        try:
+            return q.get(timeout=1.0)
+        except queue.Empty:
+            return None
+
+    running = n
+    try:
+        while running:
+            msg = await loop.run_in_executor(None, next_msg)
+            if msg is None:
+                # 子进程被杀（OOM 等）时收不到 done：全部退出且队列已空就不再等
+                if not any(pr.is_alive() for pr in procs):
+                    log(f"[ERR] {running} 个分片进程意外退出")
+                    break
+                continue
+            if msg[0] == "rows":
+                emit(msg[1], msg[2])
+            elif msg[0] == "log":
+                log(msg[1])
             else:
-                print(f"[WARN] 未抓到 m3u8：{page_url}")
+                running -= 1
+    finally:
+        for pr in procs:
+            pr.join(timeout=5)
+            if pr.is_alive():
+                pr.terminate()
+
+# ============ 页面结果缓存 ============
+
+def open_cache(path: str) -> sqlite3.Connection:
+    # 查询在主线程、写入在落盘线程（先后进行，不会并发）
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("CREATE TABLE IF NOT EXISTS c(key TEXT PRIMARY KEY, ts INTEGER, rows_json TEXT)")
+    return db
+
+def cache_key(page_url: str, deep_json: bool = False) -> str:
+    # 扫描方式不同结果可能不同：deep_json 的结果单独存放，不与默认模式互相命中
+    return hashlib.sha1((("deep:" if deep_json else "") + page_url).encode("utf-8")).hexdigest()
 
-            page.close()
+def cache_get(db: sqlite3.Connection, page_url: str, deep_json: bool = False) -> list[dict] | None:
+    """命中且未过期时返回上次的结果（可能为空列表 = 上次没抓到）；否则返回 None。"""
+    row = db.execute("SELECT ts, rows_json FROM c WHERE key=?", (cache_key(page_url, deep_json),)).fetchone()
+    if not row:
+        return None
+    ts, rows_json = row
+    rows = json.loads(rows_json)
+    # 没抓到的页面用较短的 TTL，过一阵会重试
+    ttl = CACHE_TTL_SEC if rows else CACHE_MISS_TTL_SEC
+    return rows if time.time() - ts < ttl else None
 
-        context.close()
-        browser.close()
+def cache_put(db: sqlite3.Connection, page_url: str, rows: list[dict], deep_json: bool = False) -> None:
+    db.execute("INSERT OR REPLACE INTO c VALUES (?, ?, ?)",
+               (cache_key(page_url, deep_json), int(time.time()), json.dumps(rows, ensure_ascii=False)))
+    db.commit()
 
-    # ===== 最终过滤 & 去重 =====
-    # 只保留 .m3u8 结尾的 URL
-    results = [r for r in results if r["m3u8_url"].lower().endswith(".m3u8")]
+# =======================================
 
-    # 按规范化 URL 聚合（保留第一条记录）
+async def run(workdir: str = ".", log: Callable[[str], None] = print,
+              browser: Browser | None = None, use_cache: bool = True,
+              deep_json: bool = False, procs: int | None = None) -> list[dict]:
+    """在 workdir 下读取 urls.txt、写出 m3u8_results.csv，返回写入的行；日志交给 log 回调。
+    可被同进程的调用方直接 import 使用（await run(...)），不必再起子进程。
+    传入 browser 时复用调用方常驻的 Chromium（每次只开新 context），否则自行启动并关闭。
+    use_cache 时，TTL 内抓过的页面直接取 workdir 下 CACHE_FILE 里的结果，不再打开浏览器。
+    deep_json 时用 orjson 解析 JSON 响应再逐个检查字符串值（见 find_m3u8_in_json）。
+    待抓 URL 较多时按进程分片（见 shard_count），procs 指定进程数，None 为按可用 CPU 自动决定。"""
+    urls = load_urls(os.path.join(workdir, INPUT_FILE))
+    out_csv = os.path.join(workdir, OUTPUT_CSV)
     bucket = {}
-    for r in results:
-        norm = normalize_m3u8(r["m3u8_url"])
-        if norm not in bucket:
-            r["m3u8_url"] = norm
-            bucket[norm] = r
-
-    # 若同目录存在 master 与其它，优先只保留 master
-    final_urls = prefer_master_then_unique(list(bucket.keys()))
-    results = [bucket[u] for u in final_urls]
-
-    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(f, fieldnames=["title","page_url","m3u8_url","referer","user_agent","note"])
-        writer.writeheader()
-        writer.writerows(results)
-
-    print(f"\n[DONE] 共写入 {len(results)} 条到 {OUTPUT_CSV}")
+    db = open_cache(os.path.join(workdir, CACHE_FILE)) if use_cache else None
+
+    # 边抓边写：每个 URL 完成就 flush 落盘，进程中途被杀也保留已有结果
+    # 普通 csv.writer：按固定列序用 itemgetter 直接取元组，
+    # 省掉 DictWriter 每行的字段校验与 dict→list 转换
+    with open(out_csv, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_FIELDS)
+        f.flush()
+
+        def write_rows(rows: list[dict]) -> None:
+            # 各页结果已规范化并只保留首选地址；这里只需留下 .m3u8 结尾的 URL，
+            # 并跨页按 URL 去重（保留第一条记录）
+            new = []
+            for r in rows:
+                u = r["m3u8_url"]
+                if u.lower().endswith(".m3u8") and u not in bucket:
+                    bucket[u] = r
+                    new.append(r)
+            if new:
+                writer.writerows(map(row_values, new))
+                f.flush()
+
+        def store(page_url: str, rows: list[dict]) -> None:
+            if db is not None:
+                cache_put(db, page_url, rows, deep_json)
+            write_rows(rows)
+
+        # 落盘（CSV 写入、sqlite 提交）交给单个写线程，事件循环只管驱动浏览器；
+        # 所有写入在这一个线程里顺序执行，无需加锁
+        loop = asyncio.get_running_loop()
+        disk = ThreadPoolExecutor(1)
+        pending = []
+
+        def emit(page_url: str, rows: list[dict]) -> None:
+            pending.append(loop.run_in_executor(disk, store, page_url, rows))
+
+        todo = []
+        for u in urls:
+            cached = cache_get(db, u, deep_json) if db is not None else None
+            if cached is None:
+                todo.append(u)
+            else:
+                log(f"[CACHE] {u}")
+                write_rows(cached)
+
+        try:
+            n = shard_count(len(todo), procs)
+            if browser is not None:
+                await crawl(browser, todo, log, emit, deep_json)
+            elif n > 1:
+                await crawl_sharded(todo, log, emit, deep_json, n)
+            elif todo:
+                async with async_playwright() as p:
+                    own = await p.chromium.launch(headless=True, args=CHROMIUM_ARGS)
+                    try:
+                        await crawl(own, todo, log, emit, deep_json)
+                    finally:
+                        await own.close()
+        finally:
+            try:
+                await asyncio.gather(*pending)
+            finally:
+                disk.shutdown()
+                if db is not None:
+                    db.close()
+
+    results = list(bucket.values())
+    log(f"\n[DONE] 共写入 {len(results)} 条到 {out_csv}")
+    return results
+
+def main():
+    ap = argparse.ArgumentParser(description="抓取 urls.txt 中网页的 m3u8 链接，写入 m3u8_results.csv")
+    ap.add_argument("--deep-json", action="store_true",
+                    help="用 orjson 解析 JSON 响应后逐个检查字符串（默认直接正则扫描原文）")
+    ap.add_argument("--no-cache", action="store_true",
+                    help=f"忽略并不更新 {CACHE_FILE}，所有页面重新抓取")
+    ap.add_argument("--procs", type=int, default=None,
+                    help=f"URL 超过 {SHARD_THRESHOLD} 个时的分片进程数（默认取可用 CPU 的一半，最多 {MAX_SHARD_PROCS}）")
+    args = ap.parse_args()
+    asyncio.run(run(".", use_cache=not args.no_cache, deep_json=args.deep_json, procs=args.procs))
 
 if __name__ == "__main__":
     main()
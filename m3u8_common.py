@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+app.py 与 grab_m3u8.py 共用的部分：Chromium 启动参数、m3u8 地址规范化、
+子 frame 点击播放、导航后等 DOM 或 m3u8。
+"""
+
+import asyncio
+import re
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit, urlunsplit
+
+from playwright.async_api import Frame, Page
+
+# Chromium 启动参数
+CHROMIUM_ARGS = [
+    # 在容器里能跑起来：没有可用的沙箱；/dev/shm 通常只有 64MB，共享内存改放 /tmp
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--no-zygote",
+    # 关掉无头抓取用不到的子系统，省 CPU/内存
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-features=TranslateUI,BackForwardCache",
+    "--mute-audio",
+    # 并发打开的页面都算后台页：不节流计时器、不降低渲染优先级，播放器脚本才会照常
+    # 发出 m3u8 请求（代价是多用一些 CPU）
+    "--disable-background-timer-throttling",
+    "--disable-renderer-backgrounding",
+    # 反自动化检测：去掉 navigator.webdriver 标记，少被站点拦截
+    "--disable-blink-features=AutomationControlled",
+]
+
+# 单个子 frame 点击播放的时间上限（秒）
+FRAME_CLICK_SEC = 2.0
+
+# 规范化用：截到第一个真正的 .m3u8 后缀为止（后面不能再跟字母数字或 "."，排除 m3u8.php 之类）
+M3U8_CORE_RE = re.compile(r'https?://[^"\']+?\.m3u8(?![\w.])', re.I)
+
+
+def canonicalize_m3u8(url: str) -> str:
+    """
+    规范化 m3u8 地址：截到第一个 .m3u8，去掉 query/fragment，scheme/host 小写。
+    解析接口常把真实地址放在参数里（?url=https://cdn/a.m3u8），所以从片段里最后一个
+    http(s):// 开始取。路径不以 .m3u8 结尾的（仅凭 content-type 命中、参数被编码等）原样返回。
+    """
+    m = M3U8_CORE_RE.search(url or "")
+    if not m:
+        return url
+    core = m.group(0)
+    core_l = core.lower()
+    core = core[max(core_l.rfind("http://"), core_l.rfind("https://")):]
+    parts = urlsplit(core)
+    if not parts.path.lower().endswith(".m3u8"):
+        return url
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, "", ""))
+
+
+async def click_play_in_frames(page: Page, click: Callable[[Frame], Awaitable[bool]]) -> None:
+    """
+    对 page.frames 快照里的所有子 frame 并发调用 click（各脚本自己的 try_click_play），
+    每个 frame 最多等 FRAME_CLICK_SEC。
+    """
+    frames = [fr for fr in page.frames if fr is not page.main_frame]
+    await asyncio.gather(
+        *(asyncio.wait_for(click(fr), timeout=FRAME_CLICK_SEC) for fr in frames),
+        return_exceptions=True,
+    )
+
+
+async def wait_dom_or_m3u8(page: Page, hit: asyncio.Event, timeout: float) -> None:
+    """
+    commit 返回时 DOM 可能尚未就绪：等到 domcontentloaded 或已捕获 m3u8，先到者为准。
+    """
+    dom = asyncio.ensure_future(page.wait_for_load_state("domcontentloaded", timeout=timeout * 1000))
+    got = asyncio.ensure_future(hit.wait())
+    await asyncio.wait({dom, got}, return_when=asyncio.FIRST_COMPLETED)
+    for t in (dom, got):
+        t.cancel()
+    # 回收两个任务，吞掉 DOM 等待的超时/导航异常
+    await asyncio.gather(dom, got, return_exceptions=True)